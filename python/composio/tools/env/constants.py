@@ -3,6 +3,7 @@
 EXIT_CODE = "exit_code"
 STDOUT = "stdout"
 STDERR = "stderr"
+TRUNCATED = "truncated"
 
 ECHO_EXIT_CODE = "echo $?"
 DEFAULT_IMAGE = "composio/composio"
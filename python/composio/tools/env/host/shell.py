@@ -3,7 +3,9 @@
 import os
 import re
 import select
+import selectors
 import subprocess
+import sys
 import time
 import typing as t
 from abc import abstractmethod
@@ -12,52 +14,102 @@ from pathlib import Path
 import paramiko
 
 from composio.tools.env.base import Sessionable
-from composio.tools.env.constants import ECHO_EXIT_CODE, EXIT_CODE, STDERR, STDOUT
+from composio.tools.env.constants import EXIT_CODE, STDERR, STDOUT, TRUNCATED
 from composio.tools.env.id import generate_id
 
 
-_ANSI_ESCAPE = re.compile(
-    rb"""
-    \x1B
-    (?:
-        [@-Z\\-_]
-    |
-        \[
-        [0-?]*
-        [ -/]*
-        [@-~]
-    )
-""",
-    re.VERBOSE,
-)
+# ESC followed by a single character or a CSI sequence
+_ANSI_ESCAPE = re.compile(rb"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+_ANSI_SUB = _ANSI_ESCAPE.sub
+# Whitespace at the end of a CRLF terminated line, like `str.rstrip` per line
+_TRAILING_WS = re.compile(r"(?:(?!\r\n)\s)*\r\n")
 
 
 _DEV_SOURCE = Path("/home/user/.dev/bin/activate")
-_NOWAIT_CMDS = ("cd", "ls", "pwd")
+
+# Linux pipes hold 64 KiB by default, read them in one go
+_READ_CHUNK_SIZE = 65536
+_READ_IDLE_TIMEOUT = 0.1
+_RECV_CHUNK_SIZE = 65536
+_SSH_READ_TIMEOUT = 0.3
+_SSH_SETTLE_TIMEOUT = 1.0
+
+# `fcntl.F_SETPIPE_SZ` is only exposed from Python 3.10
+_F_SETPIPE_SZ = 1031
+_PIPE_SIZE = 1 << 20
+
+
+def _grow_pipe(fd: int) -> None:
+    """
+    Grow the pipe capacity so commands with bursty output don't block on it.
+
+    Linux only, unprivileged processes are capped by `/proc/sys/fs/pipe-max-size`
+    (1 MiB by default) which needs to be raised for larger sizes. If the call
+    fails the pipe keeps the default 64 KiB capacity.
+    """
+    if sys.platform != "linux":
+        return
+
+    import fcntl  # pylint: disable=import-outside-toplevel
+
+    try:
+        fcntl.fcntl(fd, getattr(fcntl, "F_SETPIPE_SZ", _F_SETPIPE_SZ), _PIPE_SIZE)
+    except OSError:
+        pass
+
+
+def _keep_tail(text: str, size: int) -> t.Tuple[str, bool]:
+    """Keep the last `size` bytes of text, return it and whether it was cut."""
+    data = text.encode("utf-8")
+    if len(data) <= size:
+        return text, False
+    # Drop a character cut in half rather than replacing it
+    return data[len(data) - size :].decode("utf-8", errors="ignore"), True
 
 
 class Shell(Sessionable):
     """Abstract shell session."""
 
+    environment: t.Dict
+
     def sanitize_command(self, cmd: str) -> bytes:
         """Prepare command string."""
-        return (cmd.rstrip() + "\n").encode()
+        return cmd.rstrip().encode() + b"\n"
+
+    def _export_environment(self) -> str:
+        """Build a single command exporting the session environment."""
+        return "; ".join(
+            f"export {key}={value}" for key, value in self.environment.items()
+        )
 
     @abstractmethod
     def exec(self, cmd: str, wait: bool = True) -> t.Dict:
         """Execute command on container."""
 
+    def exec_many(self, cmds: t.List[str]) -> t.List[t.Dict]:
+        """Execute commands one after another."""
+        return [self.exec(cmd=cmd) for cmd in cmds]
+
 
 # TODO: Execute in a virtual environment
 class HostShell(Shell):
     """Host interactive shell."""
 
     _process: subprocess.Popen
+    _selector: selectors.BaseSelector
+
+    _EXIT_FMT = "__EXIT_%s_%d__"
+    _CMD_END_FMT = "__CMD_END_%s_%d__"
+    _STDERR_END_FMT = "__STDERR_END_%s_%d__"
+    _MARKED_CMD_FMT = "%s\necho '%s '$?; echo '%s'; echo '%s' >&2\n"
 
     def __init__(self, environment: t.Optional[t.Dict] = None) -> None:
         """Initialize shell."""
         super().__init__()
         self._id = generate_id()
+        self._seq = 0
+        # End markers of commands we stopped waiting for, keyed by pipe
+        self._stale: t.Dict[int, bytes] = {}
         self.environment = environment or {}
 
     def setup(self) -> None:
@@ -68,14 +120,20 @@ class HostShell(Shell):
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
+            bufsize=0,
             env=self.environment,
         )
+        self._selector = selectors.DefaultSelector()
+        for pipe in (self._process.stdout, self._process.stderr):
+            pipe = t.cast(t.IO[bytes], pipe)
+            os.set_blocking(pipe.fileno(), False)
+            _grow_pipe(fd=pipe.fileno())
+            self._selector.register(pipe, selectors.EVENT_READ)
+        # Run a no-op so the login output is drained before the first command
         self.logger.debug(
             "Initial data from session: %s - %s",
             self.id,
-            self._read(wait=False),
+            self.exec(cmd="true"),
         )
 
         # Load development environment if available
@@ -84,107 +142,252 @@ class HostShell(Shell):
             self.exec(f"source {_DEV_SOURCE}")
 
         # Setup environment
-        for key, value in self.environment.items():
-            self.exec(f"export {key}={value}")
-            time.sleep(0.05)
-
-    def _has_command_exited(self, cmd: str) -> bool:
-        """Waif for command to exit."""
-        _cmd, *_ = cmd.split(" ")
-        if _cmd in _NOWAIT_CMDS:
-            time.sleep(0.3)
-            return True
-
-        output = subprocess.run(  # pylint: disable=subprocess-run-check
-            ["ps", "-e"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ).stdout.decode()
-        return all(_cmd.lstrip().rstrip() not in output for _cmd in cmd.split("&&"))
+        if self.environment:
+            self.exec(cmd=self._export_environment())
 
-    def _get_exit_code(self) -> int:
-        """Get exit code of the last process."""
-        self._write(ECHO_EXIT_CODE)
-        *_, exit_code = self._read(wait=False).get(STDOUT).strip().split("\n")  # type: ignore
-        if len(exit_code) == 0:
-            return 0
-        return int(exit_code)
+    def _drain(self, key: selectors.SelectorKey, buffer: bytearray) -> None:
+        """Read everything available on a pipe, a short read means it is empty."""
+        try:
+            while True:
+                data = os.read(key.fd, _READ_CHUNK_SIZE)
+                if not data:
+                    # EOF, the shell has closed this pipe
+                    self._selector.unregister(key.fileobj)
+                    return
+                buffer.extend(data)
+                if len(data) < _READ_CHUNK_SIZE:
+                    return
+        except BlockingIOError:
+            pass
+
+    def _skip_stale(self, fd: int, buffer: bytearray) -> bool:
+        """Discard output up to the end marker of an unfinished earlier command."""
+        marker = self._stale[fd]
+        position = buffer.find(marker)
+        if position < 0:
+            return False
+        del buffer[: position + len(marker)]
+        del self._stale[fd]
+        return True
 
     def _read(
         self,
-        cmd: t.Optional[str] = None,
+        stdout_marker: t.Optional[str] = None,
+        stderr_marker: t.Optional[str] = None,
         wait: bool = True,
         timeout: float = 120.0,
+        max_output_bytes: t.Optional[int] = None,
     ) -> t.Dict:
-        """Read data from a subprocess with a timeout."""
-        stderr = t.cast(t.IO[str], self._process.stderr).fileno()
-        stdout = t.cast(t.IO[str], self._process.stdout).fileno()
-        buffer = {stderr: b"", stdout: b""}
-        if wait and cmd is None:
-            raise ValueError("`cmd` cannot be `None` when `wait` is set to `True`")
-
+        """
+        Read data from a subprocess with a timeout.
+
+        When markers are provided and `wait` is set, block until both markers
+        show up on their respective streams and trim the output at them,
+        otherwise return once the shell stays idle for a short while.
+
+        If `max_output_bytes` is set, only a rolling tail of each stream is
+        kept in memory, with room left for the protocol lines so the caller
+        can cut the command output itself down to size. `TRUNCATED` is set
+        in the result when anything was discarded.
+        """
+        stderr = t.cast(t.IO[bytes], self._process.stderr).fileno()
+        stdout = t.cast(t.IO[bytes], self._process.stdout).fileno()
+        buffer = {stderr: bytearray(), stdout: bytearray()}
+        markers: t.Dict[int, bytes] = {}
+        if stdout_marker is not None and stderr_marker is not None:
+            markers = {stdout: stdout_marker.encode(), stderr: stderr_marker.encode()}
+        # Marker offsets in the buffers and where to resume searching for them
+        positions = {stderr: -1, stdout: -1}
+        cursors = {stderr: 0, stdout: 0}
+        truncated = False
+        wait_for_markers = wait and bool(markers)
+
+        found = False
         end_time = time.time() + timeout
         while time.time() < end_time:
-            if wait and not self._has_command_exited(cmd=str(cmd)):
-                time.sleep(0.5)
-                continue
-
-            readables, _, _ = select.select([stderr, stdout], [], [], 0.1)
-            if not readables:
+            remaining = end_time - time.time()
+            events = self._selector.select(
+                timeout=(
+                    remaining
+                    if wait_for_markers
+                    else min(_READ_IDLE_TIMEOUT, remaining)
+                )
+            )
+            if not events:
+                if wait_for_markers:
+                    continue
+                break
+            for key, _ in events:
+                fd = key.fd
+                self._drain(key=key, buffer=buffer[fd])
+                # Nothing to scan while an earlier command's output is pending
+                if positions[fd] >= 0 or (
+                    fd in self._stale and not self._skip_stale(fd, buffer[fd])
+                ):
+                    continue
+                if fd in markers:
+                    marker = markers[fd]
+                    positions[fd] = buffer[fd].find(marker, cursors[fd])
+                    cursors[fd] = max(0, len(buffer[fd]) - len(marker) + 1)
+                if max_output_bytes is not None and positions[fd] < 0:
+                    # Keep a rolling tail with room for the exit code line and
+                    # a partially received end marker
+                    limit = max_output_bytes + 3 * len(markers.get(fd, b""))
+                    excess = len(buffer[fd]) - limit
+                    if excess > 0:
+                        del buffer[fd][:excess]
+                        cursors[fd] = max(0, cursors[fd] - excess)
+                        truncated = True
+            if markers and positions[stdout] >= 0 and positions[stderr] >= 0:
+                found = True
+                break
+            if not self._selector.get_map():
                 break
-            for fd in readables:
-                data = os.read(fd, 4096)
-                if data:
-                    buffer[fd] += data
-            time.sleep(0.05)
 
-        if self._process.poll() is not None:
+        # Output of a command we did not wait for shows up before the next one
+        self._stale.update(
+            (fd, marker + b"\n") for fd, marker in markers.items() if positions[fd] < 0
+        )
+
+        # Both pipes hitting EOF before the markers means the shell is gone,
+        # even if the process has not been reaped yet
+        shell_closed = markers and not found and not self._selector.get_map()
+        if shell_closed or self._process.poll() is not None:
             raise RuntimeError(
                 f"Subprocess exited unexpectedly.\nCurrent buffer: {buffer}"
             )
 
-        if time.time() >= end_time:
+        if not found and time.time() >= end_time:
             raise TimeoutError(
                 "Timeout reached while reading from subprocess.\nCurrent "
                 f"buffer: {buffer}"
             )
 
+        # Decode once, after trimming the output at the markers
+        for fd, position in positions.items():
+            if position >= 0:
+                del buffer[fd][position:]
         return {
-            STDOUT: buffer[stdout].decode(),
-            STDERR: buffer[stderr].decode(),
+            STDOUT: buffer[stdout].decode("utf-8", errors="replace"),
+            STDERR: buffer[stderr].decode("utf-8", errors="replace"),
+            TRUNCATED: truncated,
         }
 
     def _write(self, cmd: str) -> None:
-        """Write command to shell."""
+        """Write newline terminated command to shell."""
         try:
-            stdin = t.cast(t.IO[str], self._process.stdin)
-            os.write(stdin.fileno(), self.sanitize_command(cmd=cmd))
-            stdin.flush()
+            stdin = t.cast(t.IO[bytes], self._process.stdin)
+            os.write(stdin.fileno(), cmd.encode())
         except BrokenPipeError as e:
             raise RuntimeError(str(e)) from e
 
-    def exec(self, cmd: str, wait: bool = True) -> t.Dict:  # type: ignore
+    def _next_markers(self) -> t.Tuple[str, str, str]:
+        """Get exit, command end and stderr end markers for the next command."""
+        self._seq += 1
+        return (
+            self._EXIT_FMT % (self._id, self._seq),
+            self._CMD_END_FMT % (self._id, self._seq),
+            self._STDERR_END_FMT % (self._id, self._seq),
+        )
+
+    def _parse_exit_code(self, stdout: str, exit_marker: str) -> t.Tuple[str, int]:
+        """Split the exit code line off the command output."""
+        # The exit code line is the last thing echoed before the end marker,
+        # it is not available if we did not wait for the command
+        output, marker, status = stdout.rpartition(exit_marker)
+        if not marker:
+            return stdout, 0
+        try:
+            return output, int(status.strip())
+        except ValueError:
+            return output, 1
+
+    def exec(  # type: ignore
+        self,
+        cmd: str,
+        wait: bool = True,
+        max_output_bytes: t.Optional[int] = None,
+    ) -> t.Dict:
         """Execute command on container."""
-        self._write(cmd=cmd)
-        return {
-            **self._read(cmd=cmd, wait=wait),
-            EXIT_CODE: self._get_exit_code(),
-        }
+        exit_marker, command_marker, stderr_marker = self._next_markers()
+        self._write(
+            cmd=self._MARKED_CMD_FMT
+            % (cmd or "true", exit_marker, command_marker, stderr_marker)
+        )
+        output = self._read(
+            stdout_marker=command_marker,
+            stderr_marker=stderr_marker,
+            wait=wait,
+            max_output_bytes=max_output_bytes,
+        )
+        output[STDOUT], output[EXIT_CODE] = self._parse_exit_code(
+            stdout=output[STDOUT], exit_marker=exit_marker
+        )
+        if max_output_bytes is not None:
+            for stream in (STDOUT, STDERR):
+                output[stream], truncated = _keep_tail(
+                    text=output[stream], size=max_output_bytes
+                )
+                output[TRUNCATED] = output[TRUNCATED] or truncated
+        return output
+
+    def exec_many(self, cmds: t.List[str]) -> t.List[t.Dict]:
+        """Execute commands in a single write and read round-trip."""
+        if len(cmds) < 2:
+            return super().exec_many(cmds=cmds)
+
+        markers = [self._next_markers() for _ in cmds]
+        self._write(
+            cmd="".join(
+                self._MARKED_CMD_FMT % (cmd or "true", *marker)
+                for cmd, marker in zip(cmds, markers)
+            )
+        )
+        output = self._read(stdout_marker=markers[-1][1], stderr_marker=markers[-1][2])
+
+        # Every command's output ends at its own marker lines
+        stdout, stderr = output[STDOUT], output[STDERR]
+        results = []
+        for i, (exit_marker, command_marker, stderr_marker) in enumerate(markers):
+            _stdout, _stderr = stdout, stderr
+            if i < len(markers) - 1:
+                _stdout, _, stdout = stdout.partition(command_marker + "\n")
+                _stderr, _, stderr = stderr.partition(stderr_marker + "\n")
+            _stdout, exit_code = self._parse_exit_code(
+                stdout=_stdout, exit_marker=exit_marker
+            )
+            results.append(
+                {
+                    STDOUT: _stdout,
+                    STDERR: _stderr,
+                    TRUNCATED: False,
+                    EXIT_CODE: exit_code,
+                }
+            )
+        return results
 
     def teardown(self) -> None:
         """Stop and remove the running shell."""
+        self._selector.close()
         self._process.kill()
 
 
 class SSHShell(Shell):
     """Interactive shell over SSH session."""
 
+    _DONE_FMT = "__DONE_%s_%d__"
+    # The marker is split with quotes so the echoed command line won't match it
+    _DONE_CMD_FMT = "echo '__DONE_''%s_%d__' $?"
+
     def __init__(
         self, client: paramiko.SSHClient, environment: t.Optional[t.Dict] = None
     ) -> None:
         """Initialize interactive shell."""
         super().__init__()
         self._id = generate_id()
+        self._seq = 0
+        # Done marker of a command we stopped waiting for
+        self._stale: t.Optional[bytes] = None
         self.client = client
         self.environment = environment or {}
         self.channel = self.client.invoke_shell(environment=self.environment)
@@ -193,16 +396,22 @@ class SSHShell(Shell):
         """Invoke shell."""
         self.logger.debug(f"Setting up shell: {self.id}")
 
+        # The login banner is the only output we have no command to sync on,
+        # wait for it to settle so it does not leak into the first command
+        self.logger.debug(
+            "Initial data from session: %s - %s",
+            self.id,
+            self._read(timeout=_SSH_SETTLE_TIMEOUT),
+        )
+
         # Load development environment if available
         if _DEV_SOURCE.exists():
             self.logger.debug("Loading development environment")
             self.exec(f"source {_DEV_SOURCE}")
 
         # Setup environment
-        for key, value in self.environment.items():
-            self._send(f"export {key}={value}")
-            time.sleep(0.05)
-            self._read()
+        if self.environment:
+            self.exec(cmd=self._export_environment())
 
         # CD to user dir
         self.exec(cmd="cd ~/ && export PS1=''")
@@ -211,70 +420,129 @@ class SSHShell(Shell):
         """Send buffer to shell."""
         if stdin is None:
             self.channel.sendall(f"{buffer}\n".encode("utf-8"))
-            time.sleep(0.05)
             return
 
         self.channel.send(f"{buffer}\n".encode("utf-8"))
         self.channel.sendall(f"{stdin}\n".encode("utf-8"))
-        time.sleep(0.05)
-
-    def _read(self) -> str:
-        """Read buffer from shell."""
-        output = b""
-        while self.channel.recv_ready():
-            output += self.channel.recv(512)
-        while self.channel.recv_stderr_ready():
-            output += self.channel.recv_stderr(512)
-        return _ANSI_ESCAPE.sub(b"", output).decode(encoding="utf-8")
-
-    def _wait(self, cmd: str) -> None:
-        """Wait for the command to execute."""
-        _cmd, *_rest = cmd.split(" ")
-        if _cmd in _NOWAIT_CMDS or len(_rest) == 0:
-            time.sleep(0.3)
-            return
 
+    def _recv(self, timeout: float = _SSH_READ_TIMEOUT) -> bytearray:
+        """Receive raw bytes from shell, waiting up to `timeout` for data."""
+        select.select([self.channel], [], [], timeout)
+        output = bytearray()
         while True:
-            _, stdout, _ = self.client.exec_command(command="ps -eo command")
-            if all(
-                not line.lstrip().rstrip().endswith(cmd)
-                for line in stdout.read().decode().split("\n")
-            ):
-                return
-            time.sleep(0.3)
-
-    def _exit_status(self) -> int:
-        """Wait for the command to execute."""
-        self._send(buffer="echo $?")
-        try:
-            output = self._read().split("\n")
-            if len(output) == 1:
-                return int(output[0].lstrip().rstrip())
-            return int(output[1].lstrip().rstrip())
-        except ValueError:
-            return 1
+            if self.channel.recv_ready():
+                output.extend(self.channel.recv(_RECV_CHUNK_SIZE))
+            elif self.channel.recv_stderr_ready():
+                output.extend(self.channel.recv_stderr(_RECV_CHUNK_SIZE))
+            else:
+                break
+        return output
+
+    def _decode(self, output: bytearray) -> str:
+        """Strip ANSI escape sequences and decode output."""
+        if b"\x1b" in output:
+            return _ANSI_SUB(b"", output).decode("utf-8", errors="replace")
+        return output.decode("utf-8", errors="replace")
+
+    def _read(self, timeout: float = _SSH_READ_TIMEOUT) -> str:
+        """Read buffer from shell, waiting up to `timeout` for data to arrive."""
+        return self._decode(self._recv(timeout=timeout))
+
+    def _skip_stale(self, buffer: bytearray) -> bool:
+        """Discard output through the done marker line of an earlier command."""
+        if self._stale is None:
+            return True
+        position = buffer.find(self._stale)
+        if position < 0:
+            return False
+        end = buffer.find(b"\n", position)
+        if end < 0:
+            return False
+        del buffer[: end + 1]
+        self._stale = None
+        return True
+
+    def _read_until(
+        self, marker: str, wait: bool = True, timeout: float = 120.0
+    ) -> str:
+        """
+        Read from shell until `marker` shows up in the output.
+
+        Without `wait`, return whatever is available right away instead.
+        """
+        # Collect raw bytes so multi-byte characters and escape sequences split
+        # across reads are decoded and stripped in one piece
+        target = marker.encode()
+        buffer = bytearray()
+        cursor = 0
+        found = False
+        end_time = time.time() + timeout
+        while time.time() < end_time:
+            chunk = self._recv()
+            if not chunk and self.channel.closed:
+                raise RuntimeError(
+                    f"SSH channel closed unexpectedly.\nCurrent buffer: {buffer}"
+                )
+            buffer.extend(chunk)
+            # Nothing to scan while an earlier command's output is pending
+            if self._stale is not None and self._skip_stale(buffer):
+                cursor = 0
+            if self._stale is None and buffer.find(target, cursor) >= 0:
+                found = True
+                break
+            if not wait:
+                break
+            cursor = max(0, len(buffer) - len(target) + 1)
+
+        # Output of a command we did not wait for shows up before the next one
+        if not found:
+            self._stale = target
+        if wait and not found:
+            raise TimeoutError(
+                f"Timeout reached while reading from SSH channel.\nCurrent buffer: {buffer}"
+            )
+        return self._decode(buffer)
 
-    def _sanitize_output(self, output: str) -> str:
+    def _sanitize_output(self, output: str, done_cmd: t.Optional[str] = None) -> str:
         """Clean the output."""
-        lines = list(map(lambda x: x.rstrip(), output.split("\r\n")))
-        clean = "\n".join(lines[1:])
+        # The shell echoes the marker command when it reads it, after the
+        # command output, drop it along with anything that follows it
+        if done_cmd is not None and done_cmd in output:
+            output, _, _ = output.rpartition(done_cmd)
+
+        # Drop the echoed command line and trailing whitespace on every line
+        _, _, clean = output.partition("\r\n")
+        head, sep, last = clean.rpartition("\r\n")
+        clean = _TRAILING_WS.sub("\n", head + sep) + last.rstrip()
         if clean.startswith("\r"):
             clean = clean[1:]
         return clean.replace("(.dev)\n", "")
 
     def exec(self, cmd: str, wait: bool = True) -> t.Dict:
         """Execute a command and return output and exit code."""
-        output = ""
-        for _cmd in cmd.split(" && "):
-            self._send(buffer=_cmd)
-            if wait:
-                self._wait(cmd=_cmd)
-            output += self._sanitize_output(output=self._read())
+        self._seq += 1
+        marker = self._DONE_FMT % (self._id, self._seq)
+        done_cmd = self._DONE_CMD_FMT % (self._id, self._seq)
+        # Keep the marker on its own line so comments and heredocs in the
+        # command cannot swallow it
+        self._send(buffer=f"{cmd.rstrip() or 'true'}\n{done_cmd}")
+        output = self._read_until(marker=marker, wait=wait)
+
+        # The exit code is not available if we did not wait for the command
+        exit_code = 0
+        output, found, status = output.rpartition(marker)
+        if found:
+            try:
+                exit_code = int(status.split("\n", 1)[0].strip())
+            except ValueError:
+                exit_code = 1
+        else:
+            output = status
 
         return {
-            STDOUT: output,
+            STDOUT: self._sanitize_output(output=output, done_cmd=done_cmd),
             STDERR: "",
-            EXIT_CODE: str(self._exit_status()),
+            EXIT_CODE: str(exit_code),
         }
 
     def teardown(self) -> None:
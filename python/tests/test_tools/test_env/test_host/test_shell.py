@@ -1,4 +1,81 @@
-from composio.tools.env.host.shell import HostShell
+import typing as t
+from unittest.mock import MagicMock
+
+import pytest
+
+from composio.tools.env.host.shell import HostShell, SSHShell
+
+
+Responder = t.Callable[[str, str, str], t.List[bytes]]
+
+
+class StubChannel:
+    """
+    Paramiko channel stub replying to each command with scripted chunks.
+
+    One chunk arrives per `select` call, so every chunk is a separate read.
+    """
+
+    def __init__(self, respond: Responder) -> None:
+        self.respond = respond
+        self.sent: t.List[str] = []
+        self.arrivals: t.List[bytes] = []
+        self.chunks: t.List[bytes] = []
+        self.closed = False
+
+    def deliver(self) -> None:
+        if self.arrivals:
+            self.chunks.append(self.arrivals.pop(0))
+
+    def sendall(self, data: bytes) -> None:
+        # Commands are sent as `<cmd>\n<done_cmd>\n`
+        cmd, done_cmd = data.decode().rstrip("\n").rsplit("\n", 1)
+        _, head, _, tail, _ = done_cmd.split("'")
+        self.sent.append(data.decode())
+        self.arrivals.extend(self.respond(cmd, done_cmd, head + tail))
+
+    def recv_ready(self) -> bool:
+        return len(self.chunks) > 0
+
+    def recv(self, size: int) -> bytes:
+        return self.chunks.pop(0)[:size]
+
+    def recv_stderr_ready(self) -> bool:
+        return False
+
+
+def pty_output(
+    cmd: str, done_cmd: str, marker: str, output: bytes = b"", exit_code: int = 0
+) -> bytes:
+    """Build what a pty shell prints for a marked command."""
+    echo = cmd.replace("\n", "\r\n> ").encode()
+    return (
+        echo
+        + b"\r\n"
+        + output
+        + done_cmd.encode()
+        + b"\r\n"
+        + f"{marker} {exit_code}\r\n".encode()
+    )
+
+
+@pytest.fixture(name="ssh_shell")
+def fixture_ssh_shell(monkeypatch: pytest.MonkeyPatch) -> t.Callable:
+    """Create an SSH shell talking to a stub channel."""
+
+    def _select(rlist: t.List[StubChannel], *_: t.Any) -> t.Tuple:
+        for channel in rlist:
+            channel.deliver()
+        return rlist, [], []
+
+    monkeypatch.setattr("select.select", _select)
+
+    def _create(respond: Responder) -> SSHShell:
+        shell = SSHShell(client=MagicMock())
+        shell.channel = StubChannel(respond=respond)
+        return shell
+
+    return _create
 
 
 def test_host_shell() -> None:
@@ -17,3 +94,190 @@ def test_host_shell_with_env() -> None:
 
     assert output["exit_code"] == 0
     assert output["stdout"] == "John Doe\n"
+
+
+def test_host_shell_exit_code() -> None:
+    shell = HostShell()
+    shell.setup()
+    output = shell.exec(cmd="ls /nonexistent_directory")
+
+    assert output["exit_code"] == 2
+    assert output["stdout"] == ""
+    assert "No such file or directory" in output["stderr"]
+
+
+def test_host_shell_exit_raises() -> None:
+    shell = HostShell()
+    shell.setup()
+    with pytest.raises(RuntimeError, match="Subprocess exited unexpectedly"):
+        shell.exec(cmd="exit 3")
+
+
+def test_host_shell_nowait_does_not_leak_markers() -> None:
+    shell = HostShell()
+    shell.setup()
+    shell.exec(cmd="sleep 0.5; echo late", wait=False)
+    output = shell.exec(cmd="echo x")
+
+    assert output["exit_code"] == 0
+    assert output["stdout"] == "x\n"
+    assert output["stderr"] == ""
+
+
+def test_host_shell_output_without_newline() -> None:
+    shell = HostShell()
+    shell.setup()
+    output = shell.exec(cmd="printf 'no newline'")
+
+    assert output["exit_code"] == 0
+    assert output["stdout"] == "no newline"
+
+
+def test_host_shell_max_output_bytes() -> None:
+    shell = HostShell()
+    shell.setup()
+    output = shell.exec(cmd="seq 1 100000", max_output_bytes=1024)
+
+    assert output["exit_code"] == 0
+    assert output["truncated"]
+    assert len(output["stdout"]) <= 1024
+    assert output["stdout"].endswith("99999\n100000\n")
+
+
+def test_host_shell_exec_many() -> None:
+    shell = HostShell()
+    shell.setup()
+    outputs = shell.exec_many(
+        cmds=["cd /tmp", "pwd", "ls /nonexistent_directory", "printf 'a\\nb'"]
+    )
+
+    assert [output["exit_code"] for output in outputs] == [0, 0, 2, 0]
+    assert outputs[1]["stdout"] == "/tmp\n"
+    assert outputs[2]["stdout"] == ""
+    assert "No such file or directory" in outputs[2]["stderr"]
+    assert outputs[3]["stdout"] == "a\nb"
+    assert all(output["stderr"] == "" for output in outputs[:2] + outputs[3:])
+
+
+def test_host_shell_max_output_bytes_keeps_exit_code() -> None:
+    shell = HostShell()
+    shell.setup()
+    output = shell.exec(cmd="false", max_output_bytes=5)
+
+    assert output["exit_code"] == 1
+    assert output["stdout"] == ""
+    assert not output["truncated"]
+
+    output = shell.exec(cmd="seq 1 10; false", max_output_bytes=20)
+
+    assert output["exit_code"] == 1
+    assert output["truncated"]
+    assert output["stdout"] == "".join(f"{i}\n" for i in range(1, 11))[-20:]
+
+
+def test_ssh_shell_utf8_split_across_reads(ssh_shell: t.Callable) -> None:
+    def respond(cmd: str, done_cmd: str, marker: str) -> t.List[bytes]:
+        data = pty_output(cmd, done_cmd, marker, output="café\r\n".encode())
+        split = data.index(b"\xc3") + 1
+        return [data[:split], data[split:]]
+
+    output = ssh_shell(respond).exec(cmd="echo café")
+
+    assert output["exit_code"] == "0"
+    assert output["stdout"] == "café\n"
+
+
+def test_ssh_shell_ansi_escape_split_across_reads(ssh_shell: t.Callable) -> None:
+    def respond(cmd: str, done_cmd: str, marker: str) -> t.List[bytes]:
+        data = pty_output(cmd, done_cmd, marker, output=b"\x1b[31mred\x1b[0m\r\n")
+        split = data.index(b"[31m") + 2
+        return [data[:split], data[split:]]
+
+    output = ssh_shell(respond).exec(cmd="ls --color")
+
+    assert output["stdout"] == "red\n"
+
+
+def test_ssh_shell_nowait_does_not_leak_markers(ssh_shell: t.Callable) -> None:
+    pending: t.List[bytes] = []
+
+    def respond(cmd: str, done_cmd: str, marker: str) -> t.List[bytes]:
+        if cmd.startswith("sleep"):
+            data = pty_output(cmd, done_cmd, marker, output=b"late\r\n")
+            # Only the echoed command line shows up before we stop reading
+            echo = data.index(b"\r\n") + 2
+            pending.append(data[echo:])
+            return [data[:echo]]
+        return pending + [pty_output(cmd, done_cmd, marker, output=b"x\r\n")]
+
+    shell = ssh_shell(respond)
+    shell.exec(cmd="sleep 1; echo late", wait=False)
+    output = shell.exec(cmd="echo x")
+
+    assert output["exit_code"] == "0"
+    assert output["stdout"] == "x\n"
+
+
+def test_ssh_shell_exit_code(ssh_shell: t.Callable) -> None:
+    def respond(cmd: str, done_cmd: str, marker: str) -> t.List[bytes]:
+        output = b"ls: cannot access '/nonexistent_directory'\r\n"
+        return [pty_output(cmd, done_cmd, marker, output=output, exit_code=2)]
+
+    output = ssh_shell(respond).exec(cmd="ls /nonexistent_directory")
+
+    assert output["exit_code"] == "2"
+    assert output["stdout"] == "ls: cannot access '/nonexistent_directory'\n"
+
+
+def test_ssh_shell_marker_split_across_reads(ssh_shell: t.Callable) -> None:
+    def respond(cmd: str, done_cmd: str, marker: str) -> t.List[bytes]:
+        data = pty_output(cmd, done_cmd, marker, output=b"out\r\n")
+        start = data.rindex(marker.encode())
+        return [data[: start + 4], data[start + 4 : start + 7], data[start + 7 :]]
+
+    output = ssh_shell(respond).exec(cmd="echo out")
+
+    assert output["exit_code"] == "0"
+    assert output["stdout"] == "out\n"
+
+
+@pytest.mark.parametrize(
+    "cmd,expected",
+    [
+        ("echo a # note", b"a\r\n"),
+        ("cat <<EOF\nline\nEOF", b"line\r\n"),
+    ],
+)
+def test_ssh_shell_marker_on_own_line(
+    ssh_shell: t.Callable, cmd: str, expected: bytes
+) -> None:
+    def respond(cmd: str, done_cmd: str, marker: str) -> t.List[bytes]:
+        return [pty_output(cmd, done_cmd, marker, output=expected)]
+
+    shell = ssh_shell(respond)
+    output = shell.exec(cmd=cmd)
+
+    # A comment or heredoc in the command must not swallow the marker command
+    *lines, done_cmd, _ = shell.channel.sent[0].split("\n")
+    assert "\n".join(lines) == cmd
+    assert done_cmd.startswith("echo '__DONE_''")
+    assert output["exit_code"] == "0"
+    assert output["stdout"].endswith(expected.decode().replace("\r\n", "\n"))
+
+
+@pytest.mark.parametrize(
+    "output,expected",
+    [
+        ("cmd\r\nb \n\r\nc", "b\nc"),
+        ("cmd\r\nfoo\n", "foo"),
+        ("cmd\r\na \t\r\n\r\nb\r\n", "a\n\nb\n"),
+        ("cmd\r\n\rout\r\n", "out\n"),
+        ("cmd\r\n(.dev)\r\nout\r\n", "out\n"),
+    ],
+)
+def test_ssh_shell_sanitize_output(
+    ssh_shell: t.Callable, output: str, expected: str
+) -> None:
+    shell = ssh_shell(lambda *_: [])
+    # pylint: disable=protected-access
+    assert shell._sanitize_output(output=output) == expected